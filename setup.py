@@ -1,5 +1,4 @@
 from setuptools import setup, find_packages
-from Cython.Build import cythonize
 import os
 
 # Use Semantic Versioning, http://semver.org/
@@ -33,6 +33,10 @@ Turns RF board off
 Requires Python3.8+
 """
 
+import io
+import multiprocessing
+import os
+import queue
 import sys
 import time
 from collections import OrderedDict
@@ -51,11 +55,229 @@ font.setFixedPitch(False)
 font.setPointSize(11)
 
 
+class AA30Serial():
+    """ Low-level serial I/O with the RigExpert AA30.
+    This runs in the acquisition process (see _serial_worker); the GUI
+    talks to it only through the command and data queues. """
+    def __init__(self):
+        self.re_sp = None # Serial port associated with the AA30
+
+    def open(self, port:str):
+        """Open the serial port to the AA30
+
+        Parameters
+        ----------
+        port : str
+            device name of the serial port
+
+        Raises
+        ------
+        ConnectionError
+            Exception is raised when port connection fails (no device)
+        """
+        try:
+            self.re_sp = serial.Serial(port,  # when plugged into the right side port
+                bytesize=8, parity='N', stopbits=1, baudrate=38400, timeout=3)
+        except:
+            raise ConnectionError('Did not find a serial port connected to an AA-30')
+        if self.re_sp is None:
+            raise ConnectionError('Did not find a serial port connected to an AA-30')
+        self.set_low_latency(port)
+
+    def set_low_latency(self, port:str):
+        """The AA-30 returns many small packets; with the default FTDI latency
+        timer (16 msec) each one waits for the timer to expire. Try to drop the
+        latency to ~1 msec. This is best effort: pyserial only supports
+        low latency mode on Linux, and the sysfs latency_timer may not be writable
+        (a udev rule can set it instead:
+        ACTION=="add", SUBSYSTEM=="usb-serial", DRIVER=="ftdi_sio", ATTR{latency_timer}="1")
+
+        Parameters
+        ----------
+        port : str
+            device name of the serial port (e.g., /dev/ttyUSB0)
+        """
+        try:
+            self.re_sp.set_low_latency_mode(True)
+            return
+        except (AttributeError, NotImplementedError, OSError, ValueError):
+            pass
+        timer = f"/sys/bus/usb-serial/devices/{os.path.basename(port)}/latency_timer"
+        try:
+            with open(timer, 'w') as fh:
+                fh.write('1')
+        except OSError:
+            pass  # not linux, or no permission; keep the default latency
+
+    def re_version(self):
+        self.send_re('VER')
+        return self.get_re()
+
+    def re_on(self):
+        self.send_re('ON')
+        r = self.get_re()
+        time.sleep(0.2)  # give it time to turn on
+        return r
+
+    def re_off(self):
+        self.send_re('OFF')
+        return self.get_re()
+
+    def sweep(self, start_freq:float, end_freq:float, nfreq:int,
+              data_q:multiprocessing.Queue, stop_event):
+        """Do an FRX sweep, and put each point on the data queue as it arrives
+        as ('point', n, line), where line holds the raw "f,r,x" bytes (parsing is
+        done in batches by the GUI). The sweep ends with ('done', status), where
+        status is 'OK', 'stopped', or a description of the failure.
+
+        Parameters
+        ----------
+        start_freq, end_freq : float
+            frequency range of the sweep, in MHz
+        nfreq : int
+            number of steps; nfreq+1 points are returned
+        data_q : multiprocessing.Queue
+            queue to put the results on
+        stop_event : multiprocessing.Event
+            when set, the sweep is abandoned
+        """
+        fq =start_freq+(end_freq - start_freq)/2.0
+        span = end_freq - start_freq
+        self.send_re('FQ%d' % int(fq*1e6))
+        r = self.get_re()
+        if r not in ['OK']:
+            print('Response  not "OK", got ""{0}"" instead'.format(r))
+            data_q.put(('done', 'Failed to set frequency'))
+            return
+#        print ('FQ command returned: {:s}'.format(r))
+        time.sleep(0.05)
+        self.send_re('sw%d' % int(span*1e6))
+        r = self.get_re()
+        if r not in ['OK']:
+            # print (r)
+            data_q.put(('done', 'Failed to set sweep range'))
+            return
+#        print ('Command SW returned: ', r)
+        time.sleep(0.02)
+        self.send_re('FRX%d' % nfreq)
+        r = self.get_re()
+        if r not in ['OK']:
+            # print (r)
+            data_q.put(('done', 'Failed to set frx'))
+            return
+        n = 0  # index of the next data point
+        # read until the closing OK; bounded, allowing for line breaks between the points
+        for i in range(2*(nfreq+1) + 2):
+            if stop_event.is_set():
+                # the AA-30 keeps sending the rest of the sweep; read it so
+                # the next command does not see stale points
+                self._skip_to_ok(max_lines=nfreq+1-n)
+                data_q.put(('done', 'stopped'))
+                return
+            x = self._readline()
+            if not x.endswith(b'\r\n'):  # read timed out (nothing, or a partial line): the device went quiet
+                data_q.put(('done', 'Timed out waiting for FRX data'))
+                return
+            if x.startswith(b'ERROR'):  # oops, not good
+                data_q.put(('done', 'Processing canceled by user'))
+                return
+            if x.startswith(b'OK'):  # an ok means we are done!
+                print ('FRX completed OK')
+                data_q.put(('done', 'OK'))
+                return
+            if len(x) > 2 and n <= nfreq:  # skip line breaks
+                data_q.put(('point', n, x.rstrip(b'\r\n')))
+                n += 1
+        data_q.put(('done', 'FRX did not end with OK'))
+
+    def send_re(self, cmd):
+        cmd = cmd + '\r'
+
+        self.re_sp.write(cmd.encode())
+        
+    def get_re(self, verbose = False):
+        """
+        Read after a command to the AA-30
+        Commands are a response consisting of:
+        <cr><lf>value<cr><lf>
+        optionally followed by
+        <cr><lf>OK<cr><lf>
+        The response is read a line at a time (rather than a character at a time),
+        and the first non-empty line is returned as a string.
+        """
+        while True:
+            line = self.re_sp.read_until(b'\r\n')
+            if verbose:
+                print ('line: ', line)
+            if len(line) == 0:  # no characters (timeout), likely the device is not on
+                return None
+            if line == b'\r\n':  # skip the leading (empty) line breaks
+                continue
+            s = line.rstrip(b'\r\n').decode()
+            if verbose: 
+                print ('s:[%s] ' % s)
+            if len(s) > 0:
+                return s
+            else:
+                return None
+
+    def _skip_to_ok(self, max_lines:int):
+        """Discard lines until the closing OK of a command, or a timeout"""
+        for i in range(2*max_lines + 2):  # allow for line breaks between the points, and around OK
+            x = self._readline()
+            if not x.endswith(b'\r\n') or x.startswith(b'OK'):
+                break
+
+    def _readline(self) -> bytes:
+        """Read one <cr><lf> terminated line (as bytes, including the <cr><lf>).
+        Returns whatever has arrived (possibly b'') if the read times out."""
+        return self.re_sp.read_until(b'\r\n')
+
+
+def _serial_worker(cmd_q:multiprocessing.Queue, data_q:multiprocessing.Queue,
+                   stop_event, port:str):
+    """Acquisition process: owns the serial port, and runs the commands
+    posted on cmd_q. Simple commands ('ON', 'OFF', 'VER') put ('reply', response)
+    on data_q; ('FRX', start_freq, end_freq, nfreq) streams the sweep
+    (see AA30Serial.sweep); ('QUIT',) ends the process.
+    The first message on data_q is ('reply', 'OK') if the port opened,
+    or ('reply', None) if it did not.
+    """
+    aa30 = AA30Serial()
+    try:
+        aa30.open(port)
+    except ConnectionError:
+        data_q.put(('reply', None))
+        return
+    data_q.put(('reply', 'OK'))
+    commands = {'ON': aa30.re_on, 'OFF': aa30.re_off, 'VER': aa30.re_version}
+    while True:
+        cmd = cmd_q.get()
+        if cmd[0] == 'QUIT':
+            break
+        if cmd[0] == 'FRX':
+            try:
+                aa30.sweep(*cmd[1:], data_q=data_q, stop_event=stop_event)
+            except Exception as err:  # keep the worker alive, and tell the GUI the sweep is over
+                data_q.put(('done', str(err)))
+        else:
+            try:
+                r = commands[cmd[0]]()
+            except Exception as err:  # (e.g., the device was unplugged) keep the worker alive
+                print('%s failed: %s' % (cmd[0], err))
+                r = None
+            data_q.put(('reply', r))
+
+
 class REAA30():
     """ Class to control and display data from RigExpert AA30
     build the UI and instantiate buttons and actions """
     def __init__(self):
-        self.re_sp = None # Serial port associated with teh AA30
+        # serial I/O runs in a separate process (_serial_worker), fed by these queues
+        self._worker = None
+        self._cmd_q = multiprocessing.Queue()
+        self._data_q = multiprocessing.Queue()
+        self._stop_event = multiprocessing.Event()
         self.find_port()
 
         self.done = True
@@ -82,10 +304,32 @@ class REAA30():
                              ('10cw', [27.980, 28.320, 50]), ('10ph', [28.280, 28.520, 50]), ('10full', [28.0, 29.7, 100]),
                              ('All', None), ('CW', None), ('PH', None),
                              ])
+        # the preset "sets" of bands, and the suffix of the band names they scan
+        self.band_sets = {'All': 'full', 'CW': 'cw', 'PH': 'ph'}
+        # the same bands as parallel arrays, for dispatching the sets
+        self._band_names = np.array(list(self.bands.keys()))
+        self._band_ranges = np.array([v if v is not None else [np.nan]*3 for v in self.bands.values()],
+                                     dtype=np.float64)
+        self._valid = ~np.isnan(self._band_ranges[:,0])
+        self._band_set_masks = {k: np.char.endswith(self._band_names, v) & self._valid
+                                for k, v in self.band_sets.items()}
         self.band_select = 'HF'
         self.stopscan = False
         self.color_index = 0
         self.in_sampling = False
+        self.plot_interval = 0.05  # time (sec) between live plot updates during a sweep
+        # pens for the scans, by color_index, and for X
+        self._npens = 9
+        self._pen_cache = [pg.mkPen(cosmetic=True, width=1.0,
+                               color=pg.intColor(i, hues=self._npens, values=1, maxValue=255,
+                                   minValue=150, maxHue=360, minHue=0, sat=255, alpha=255))
+                           for i in range(self._npens)]
+        self._x_pen = pg.mkPen(cosmetic=True, width=1.0, color='b', 
+                               style=QtCore.Qt.PenStyle.DashLine)
+        # cursor readout: last position handled, and last value shown in each label
+        self._last_pos = QtCore.QPointF()
+        self._last_labels = {'R': None, 'SWR': None, 'RTL': None}
+        self._mouse_html = "<p style='color:white'>F： {0:.2f} <br> R: {1:.2f}</p>"
         self.build_ui()
         self.win.show()
 
@@ -104,16 +348,12 @@ class REAA30():
         aa_30_port = '/dev/cu.usbserial-220'
         print("ports: ", ports)
         if aa_30_port in ports:
-
-            try:
-                self.re_sp = serial.Serial(aa_30_port,  # when plugged into the right side port
-                    bytesize=8, parity='N', stopbits=1, baudrate=38400, timeout=3)
-            except:
-                raise ConnectionError('Did not find a serial port connected to an AA-30')
-            if self.re_sp is None:
+            self._worker = multiprocessing.Process(target=_serial_worker,
+                args=(self._cmd_q, self._data_q, self._stop_event, aa_30_port), daemon=True)
+            self._worker.start()
+            if self._get_reply() is None:
                 raise ConnectionError('Did not find a serial port connected to an AA-30')
 
-        
     def build_ui(self):
         """
         Create user interface with plots.
@@ -234,7 +474,6 @@ class REAA30():
         # self.pl['SWR'].addItem(SWR_hLine, ignoreBounds=True)
         # self.pl['SWR'].setMouseTracking(True)
         # print(dir(self.pl['R'].scene()))
-        self.pl['SWR'].scene().sigMouseMoved.connect(self.onMouseMoved)
         self.SWR_label.setAnchor((0,0)) # itemPos=(0,0), parentPos=(0,0), offset=(-10,10))
      
         #
@@ -248,10 +487,11 @@ class REAA30():
         # self.pl['RTL'].addItem(RTL_hLine, ignoreBounds=True)
         # self.pl['RTL'].setMouseTracking(True)
         # print(dir(self.pl['R'].scene()))
-        self.pl['RTL'].scene().sigMouseMoved.connect(self.onMouseMoved)
+        # the plots share one scene, so the mouse is connected once (above)
+        self._mouse_labels = {'R': self.R_label, 'SWR': self.SWR_label, 'RTL': self.RTL_label}
         self.win.show()
 
-        self.ptreedata.sigTreeStateChanged.connect(self.command_dispatcher)  # connect parameters to their updates
+        self.connect_parameters()  # connect parameters to their updates
 
         # Start Qt event loop unless running in interactive mode.
         # Event loop will wait for the GUI to activate the updater and start sampling.
@@ -259,127 +499,97 @@ class REAA30():
         if (sys.flags.interactive != 1) or not hasattr(QtCore, 'PYQT_VERSION'):
             QtGui.QGuiApplication.instance().exec()
 
-    def command_dispatcher(self, param, changes):
+    def connect_parameters(self):
         """
-        Respond to changes in the parametertree and update class variables
-        Serves to update variables
-        Dispatches actions required by button press
-        
-        Parameters
-        ----------
-        param : parameter list returned from the parameter tree object
-    
-        changes : changes as returned from the parameter tree object
-    
-        Returns
-        -------
-        Nothing
-    
+        Connect each entry in the parametertree directly to the class variable
+        it updates, or to the action it dispatches on a button press
         """
-        for param, change, data in changes:
-            path = self.ptreedata.childPath(param)
-
-            # if path is not None:
-            #     childName = '.'.join(path)
-            # else:
-            #     childName = param.name()
-            #
-            # Parameters and user-supplied information
-            #
-            if path[1] == 'Quit':
-                exit()
-            if path[1] == 'Filename':
-                self.filename = data
-            if path[1] == 'Low F':
-                self.start_freq = data
-            if path[1] == 'High F':
-                self.end_freq = data
-            if path[1] == 'NFreqs':
-                # print(f'nFreqs: {data:d}')
-                self.nfreqs = data
-            if path[1] == 'Info':
-                self.InfoText = data
-            if path[1] == 'Presets':
-                self.band_select = data
-                print('band select data: ', data)
-            #
-            # Actions:
-            #
-            if path[1] == 'Start Single Scan':
-                (fr, rx, zx, rtl) = self.re_sample(start_freq=self.start_freq, end_freq=self.end_freq, nfreq=self.nfreqs)
-                self.color_index += 1
-            if path[1] == 'Start Repeated Scans':
-                self.clear_plots()
-                self.done = False
-                self.repeat_scan()
-                
-            if path[1] == 'Start Preset Scans':
-                if self.band_select.endswith(('cw', 'ph', 'full', "HF")):
-                    b = self.band_select
-                    print("b: ", b)                    
-                    (fr, rx, zx, rtl) = self.re_sample(start_freq=self.bands[b][0], end_freq=self.bands[b][1],
-                        nfreq=self.bands[b][2])
-                    self.color_index += 1
-                elif self.band_select == "All":
-                    for b in self.bands.keys():
-                        if b.endswith(("full")):  # only do "full" band scans
-                            (fr, rx, zx, rtl) = self.re_sample(start_freq=self.bands[b][0], end_freq=self.bands[b][1],
-                                nfreq=self.bands[b][2])
-                    self.color_index += 1
-                elif self.band_select == "CW":
-                    for b in self.bands.keys():
-                        if b.endswith(("cw")):  # only do "full" band scans
-                            (fr, rx, zx, rtl) = self.re_sample(start_freq=self.bands[b][0], end_freq=self.bands[b][1],
-                                nfreq=self.bands[b][2])
-                    self.color_index += 1
-                elif self.band_select == "PH":
-                    for b in self.bands.keys():
-                        if b.endswith(("ph")):  # only do "full" band scans
-                            (fr, rx, zx, rtl) = self.re_sample(start_freq=self.bands[b][0], end_freq=self.bands[b][1],
-                                nfreq=self.bands[b][2])
-                    self.color_index += 1
-                else:
-                    print("Band Select is not Mapped: ", self.band_select)
-                    return
-
-            if path[1] == 'Stop Scan':
-                self.done = True
-                self.stop_scan()
-            if path[1] == 'Reset/Clear plots':
-                self.clear_plots()
-            if path[1] == 'Reset AA-30':
-                self.resetAA30()
-            # if path[1] == 'Continue':
-            #     self.continueRun()
-            if path[1] == 'Save Scan':
-                self.storeData()
-            if path[1] == 'Load Scan':
-                pass
-                fn = self.getFilename()
-                if fn is not None:
-                    self.loadData(filename=fn)
-            if path[1] == 'New Filename':
-                pass
-                # self.filename = self.makeFilename()
+        group = self.ptreedata.child('Acquisition Parameters')
+        # Parameters and user-supplied information
+        values = {'Filename': 'filename', 'Low F': 'start_freq', 'High F': 'end_freq',
+                  'NFreqs': 'nfreqs', 'Info': 'InfoText', 'Presets': 'band_select'}
+        for name, attr in values.items():
+            group.child(name).sigValueChanged.connect(
+                lambda param, data, attr=attr: setattr(self, attr, data))
+        # Actions:
+        actions = {'Quit': self.quit,
+                   'Start Single Scan': self.single_scan,
+                   'Start Repeated Scans': self.start_repeat_scan,
+                   'Start Preset Scans': self.preset_scan,
+                   'Stop Scans': self.stop_scan,
+                   'Reset/Clear plots': self.clear_plots,
+                   'Reset AA-30': self.resetAA30,
+                   'Save Scan': self.storeData,
+                   'Load Scan': self.load_scan,
+                   # 'New Filename': self.makeFilename,
+                   }
+        for name, action in actions.items():
+            group.child(name).sigActivated.connect(lambda param, action=action: action())
+
+    def quit(self):
+        """Stop any scan in progress, turn the RF board off, and end the
+        acquisition process before exiting"""
+        self.stop_scan()
+        if self._worker is not None and self._worker.is_alive():
+            self._cmd_q.put(('OFF',))  # runs after the (stopped) sweep finishes
+            self._cmd_q.put(('QUIT',))
+            self._worker.join(timeout=10.)
+        exit()
+
+    def single_scan(self):
+        self.re_sample(start_freq=self.start_freq, end_freq=self.end_freq, nfreq=self.nfreqs)
+        self.color_index += 1
+
+    def start_repeat_scan(self):
+        if not self.done or self.in_sampling:  # already repeating, or another scan is running
+            return
+        self.clear_plots()
+        self.done = False
+        self.repeat_scan()
+
+    def preset_scan(self):
+        """Scan the selected preset band, or set of bands"""
+        if self.in_sampling:  # a scan is already running
+            return
+        if self.band_select.endswith(('cw', 'ph', 'full', "HF")):
+            b = self.band_select
+            print("b: ", b)                    
+            self.re_sample(start_freq=self.bands[b][0], end_freq=self.bands[b][1],
+                nfreq=self.bands[b][2])
+            self.color_index += 1
+        elif self.band_select in self.band_sets:
+            ranges = self._band_ranges[self._band_set_masks[self.band_select]]
+            self.re_on()  # leave the RF board on for the whole set of bands
+            for start_freq, end_freq, nfreq in ranges:
+                result = self.re_sample(start_freq=start_freq, end_freq=end_freq,
+                    nfreq=int(nfreq), manage_rf=False)
+                if result is None or self.stopscan:  # a failure or Stop ends the whole set
+                    break
+            self.re_off()
+            self.color_index += 1
+        else:
+            print("Band Select is not Mapped: ", self.band_select)
+
+    def load_scan(self):
+        fn = self.getFilename()
+        if fn is not None:
+            self.loadData(filename=fn)
 
     def repeat_scan(self):
         """Repeat the last scan, identically
         """        
         while not self.done:
-            (fr, rx, zx, rtl) = self.re_sample(start_freq=self.start_freq, end_freq=self.end_freq, nfreq=self.nfreqs)
+            if self.re_sample(start_freq=self.start_freq, end_freq=self.end_freq, nfreq=self.nfreqs) is None:
+                self.done = True  # the scan was not run, or failed
+                break
             self.color_index += 1
         
-    def band_find(self, b):
-        bl = []
-        for k in self.bands.keys():
-            if k[-2:] == b:
-                bl.append(k)
-        return bl
-
     def compute_swr_and_return_loss(self, re:Union[float, np.ndarray],
                                           im:Union[float, np.ndarray],
-                                          z0:float=50.):
-        """_summary_
+                                          z0:float=50.,
+                                          swr:Union[np.ndarray, None]=None,
+                                          rtl:Union[np.ndarray, None]=None):
+        """Compute the SWR and return loss from the impedance
 
         Parameters
         ----------
@@ -390,16 +600,32 @@ class REAA30():
         z0 : float
             nominal load resistance (x = 0), optional
             by default 50.
+        swr, rtl : np.ndarray, optional
+            arrays (the same size as re) to write the results into,
+            by default new arrays are allocated
         """
-        z0c = complex(z0, 0.0)
-        rho = np.zeros(len(re))
-        for i in range(len(re)):
-            z = complex(re[i], im[i])
-            rho[i] = np.abs((z - z0c)/(z + z0c))
-            if np.abs(rho[i] - 1) < 1e-3:
-                rho[i] = 1e-3
-        swr = (1.0 + rho)/(1.0 - rho)
-        rtl = 20. * np.log10(rho)
+        re = np.atleast_1d(np.asarray(re, dtype=np.float64))
+        im = np.atleast_1d(np.asarray(im, dtype=np.float64))
+        # |rho|^2 = |z - z0|^2 / |z + z0|^2, computed in place with real arithmetic
+        x2 = np.square(im)
+        rho = np.subtract(re, z0)
+        np.square(rho, out=rho)
+        rho += x2
+        den = np.add(re, z0)
+        np.square(den, out=den)
+        den += x2
+        rho /= den
+        np.sqrt(rho, out=rho)
+        np.clip(rho, 1e-12, 1.0 - 1e-3, out=rho)  # guard the singular values at rho = 0 and 1
+        if swr is None:
+            swr = np.empty_like(rho)
+        if rtl is None:
+            rtl = np.empty_like(rho)
+        np.add(1.0, rho, out=swr)
+        np.subtract(1.0, rho, out=den)
+        swr /= den
+        np.log10(rho, out=rtl)
+        rtl *= 20.
         return(swr, rtl)
     
     def compute_tdr(self, fr:np.ndarray, rtl:np.ndarray, z0=50., vf=1.0):
@@ -415,14 +641,22 @@ class REAA30():
             specified load impedance, by default 50. + 0j
         vf : float, optional
             velocity factor (for cable), by default 1.0
+
+        The return loss is converted back to the magnitude of the reflection
+        coefficient, and transformed with a real inverse FFT, zero-padded
+        to a power of 2 (at least twice the number of frequencies).
+        Returns the time base (usec when fr is in MHz) and the tdr.
         """
         # print ('rtl: ', rtl)
-        tdr = np.fft.ifft(rtl)
-        ft = np.mean(np.diff(fr))
-        t = 1./fr
+        rho = np.power(10.0, np.asarray(rtl, dtype=np.float64)/20.0)
+        rho[~np.isfinite(rho)] = 0.0  # missing points do not contribute
+        N = 1 << ((len(rho)-1).bit_length()+1)
+        tdr = np.fft.irfft(rho, n=N)
+        ft = np.nanmean(np.diff(fr))  # frequency step
+        t = np.arange(N) / (N*ft)
         # print('tdr t: ', t)
-        # print('tdr rtl: ', tdr.real)
-        return(t, tdr.real)
+        # print('tdr rtl: ', tdr)
+        return(t, tdr)
 
     def clear_plots(self):
         self.color_index = 0
@@ -430,6 +664,8 @@ class REAA30():
             self.pl[k].clear()
 
     def resetAA30(self):
+        if self.in_sampling:  # the port is busy with a sweep
+            return
         self.re_off()
         self.re_on()
 
@@ -447,215 +683,188 @@ class REAA30():
 
     def onMouseMoved(self, evt):
         pos = evt
-        if self.pl['R'].vb.sceneBoundingRect().contains(pos):
-            point =self.pl['R'].vb.mapSceneToView(pos)
-            self.R_label.setHtml(
-                "<p style='color:white'>F： {0} <br> R: {1}</p>".\
-                format(f"{point.x():.2f}", f"{point.y():.2f}")
-            )
-        elif self.pl['SWR'].vb.sceneBoundingRect().contains(pos):
-            point =self.pl['SWR'].vb.mapSceneToView(evt)
-            self.SWR_label.setHtml(
-                "<p style='color:white'>F： {0} <br> R: {1}</p>".\
-                format(f"{point.x():.2f}", f"{point.y():.2f}")
-            )
-
-        elif self.pl['RTL'].vb.sceneBoundingRect().contains(pos):
-            point =self.pl['RTL'].vb.mapSceneToView(evt)
-            self.RTL_label.setHtml(
-                "<p style='color:white'>F： {0} <br> R: {1}</p>".\
-                format(f"{point.x():.2f}", f"{point.y():.2f}")
-            )
-        else:
-            pass
-            
+        if (pos - self._last_pos).manhattanLength() < 2:  # has not really moved
+            return
+        self._last_pos = pos
+        for plot, label in self._mouse_labels.items():
+            if self.pl[plot].vb.sceneBoundingRect().contains(pos):
+                point = self.pl[plot].vb.mapSceneToView(pos)
+                values = (round(point.x(), 2), round(point.y(), 2))
+                if values != self._last_labels[plot]:  # only update the label when the value changes
+                    self._last_labels[plot] = values
+                    label.setHtml(self._mouse_html.format(*values))
+                break
+
+    def new_curves(self):
+        """Create the (empty) curves for a new scan; plot_results then
+        only updates their data. Previous scans stay on the plots.
+
+        Returns
+        -------
+        the pen, so we can use it at the end to plot the tdr
+        """
+        p = self._pen_cache[self.color_index % self._npens]
+        self.curve = {}
+        self.curve['R'] = self.pl['R'].plot([], [], pen=p)
+        self.curve['X'] = self.pl['R'].plot([], [], pen=self._x_pen) 
+        self.curve['RTL'] = self.pl['RTL'].plot([], [], pen=p)
+        self.curve['SWR'] = self.pl['SWR'].plot([], [], pen=p)
+        return(p)
 
     def plot_results(self, freq:np.ndarray, re: np.ndarray, im: np.ndarray,
-                    swr: np.ndarray, rtl: np.ndarray, first:bool=True):
-        c = pg.intColor(self.color_index, hues=9, values=1, maxValue=255,
-            minValue=150, maxHue=360, minHue=0, sat=255, alpha=255)
-        p = pg.mkPen(cosmetic=True, width=1.0, color=c)
-        p2 = pg.mkPen(cosmetic=True, width=1.0, color='b', 
-                style=QtCore.Qt.PenStyle.DashLine)
-        
-        if first:
-            self.curve = {}
-            self.curve['R'] = self.pl['R'].plot(freq, re, pen=p)
-            self.curve['X'] = self.pl['R'].plot(freq, im, pen=p2) 
-            #pg.PlotCurveItem(fr, zx, pen=p2)
-            #self.pl['X'].addItem(self.curve['X'])
-            self.curve['RTL'] = self.pl['RTL'].plot(freq, rtl, pen=p)
-            self.curve['SWR'] = self.pl['SWR'].plot(freq, swr, pen=p)
-        else:
-            self.curve['R'].setData(freq, re)
-            self.curve['X'].setData(freq, im)
-            self.curve['RTL'].setData(freq, rtl)
-            self.curve['SWR'].setData(freq, swr)
+                    swr: np.ndarray, rtl: np.ndarray):
+        self.curve['R'].setData(freq, re)
+        self.curve['X'].setData(freq, im)
+        self.curve['RTL'].setData(freq, rtl)
+        self.curve['SWR'].setData(freq, swr)
         self.app.processEvents()
-        return(p)  # return the pen so we can use it at the end to plot the tdr
 
     def re_version(self):
         self.re_off()
         self.re_on()
-        self.send_re('VER')
-        r = self.get_re()
+        r = self._command('VER')
         if r is None:
             print ('RE AA-30 appears to be not responding - is it on?')
             exit()
         print ("RE AA-30 Version = %s" % (r))
 
     def re_on(self):
-        self.send_re('ON')
-        r = self.get_re()
+        r = self._command('ON')
         if r != 'OK':
             print ('ON returned: %s' % (r))
-        time.sleep(0.2)  # give it time to turn on
 
     def stop_scan(self):
+        self.done = True
         self.stopscan = True
+        self._stop_event.set()
+
+    def re_sample(self, start_freq=2., end_freq=30., nfreq=10, manage_rf:bool=True):
+        """Do one sweep, plotting the results as they arrive.
+
+        Parameters
+        ----------
+        start_freq, end_freq : float
+            frequency range of the sweep, in MHz
+        nfreq : int
+            number of steps in the sweep
+        manage_rf : bool, optional
+            turn the RF board on before and off after the sweep, by default True.
+            Callers doing a series of sweeps can turn it on once around the whole series.
 
-    def re_sample(self, start_freq=2., end_freq=30., nfreq=10):
+        Returns
+        -------
+        (freqlist, rx, zx, tdr), or None if the scan was not run (another scan is
+        in progress) or failed
+        """
         if self.in_sampling:
             return  # ignore request
         self.in_sampling = True
         self.stopscan=False
+        self._stop_event.clear()
 #        print('cf: %f  span: %f  nfreq: %d', cf, span, nfreq)
-        results = []
         freqlist = np.linspace(start_freq, end_freq, num=nfreq+1)
         rx = np.zeros_like(freqlist)
         zx = np.zeros_like(freqlist)
         swr = np.zeros_like(freqlist)
         rtl = np.zeros_like(freqlist)
 
-       
-        self.plot_results(freq=freqlist, re=rx, im=zx, swr=swr, rtl=rtl)
-
-        self.re_on()
-        fq =start_freq+(end_freq - start_freq)/2.0
-        span = end_freq - start_freq
-        self.send_re('FQ%d' % int(fq*1e6))
-        r = self.get_re()
-        if r not in ['OK']:
-            print('Response  not "OK", got ""{:s}"" instead'.format(r))
-            self.re_off()
-            self.in_sampling = False
-            raise Exception('Failed to set frequency')
-#        print ('FQ command returned: {:s}'.format(r))
-        time.sleep(0.05)
-        self.send_re('sw%d' % int(span*1e6))
-        r = self.get_re()
-        if r not in ['OK']:
-            # print (r)
+        pen = self.new_curves()
+
+        if manage_rf:
+            self.re_on()
+        self._cmd_q.put(('FRX', start_freq, end_freq, nfreq))
+        # the worker streams the points; pull them off the queue in batches,
+        # and update the plots once per batch
+        state = {'n': 0, 'status': None, 'error': None}
+        wait_loop = QtCore.QEventLoop()
+
+        def drain():
+            n0 = state['n']
+            index = []
+            lines = []
+            while state['status'] is None:
+                try:
+                    msg = self._data_q.get_nowait()
+                except queue.Empty:
+                    break
+                if msg[0] == 'point':
+                    index.append(msg[1])
+                    lines.append(msg[2])
+                elif msg[0] == 'done':
+                    state['status'] = msg[1]
+            if state['status'] is None and not self._worker.is_alive():
+                state['status'] = 'Acquisition process ended unexpectedly'
+            if len(lines) > 0:  # parse the whole batch at once
+                try:
+                    data = np.loadtxt(io.BytesIO(b'\n'.join(lines)), delimiter=',',
+                                      dtype=np.float64, ndmin=2)
+                except ValueError as err:  # malformed line: do not raise in the timer slot
+                    # stop the sweep, and report the error once the worker says it is done
+                    self._stop_event.set()
+                    state['error'] = 'Could not parse FRX data: %s' % err
+                    lines = []
+            if state['error'] is not None:
+                lines = []  # ignore the rest of the sweep
+                if state['status'] is not None:
+                    state['status'] = state['error']
+            if len(lines) > 0:
+                data[data[:,0] <= 0.0, :] = np.nan
+                freqlist[index] = data[:,0]
+                rx[index] = data[:,1]
+                zx[index] = data[:,2]
+                state['n'] = index[-1] + 1
+            n = state['n']
+            if n > n0:  # only the new points need swr/rtl
+                self.compute_swr_and_return_loss(re=rx[n0:n], im=zx[n0:n], z0=50.,
+                                                 swr=swr[n0:n], rtl=rtl[n0:n])
+                self.plot_results(freq=freqlist[:n], re=rx[:n], im=zx[:n], 
+                                  swr=swr[:n],
+                                  rtl=rtl[:n])
+            if state['status'] is not None:
+                wait_loop.quit()
+
+        timer = QtCore.QTimer()
+        timer.timeout.connect(drain)
+        timer.start(int(self.plot_interval*1000))
+        wait_loop.exec()
+        timer.stop()
+        self.in_sampling = False
+        if state['status'] not in ['OK', 'stopped']:
+            # report and return; an exception would abort the app from inside the Qt slot
+            print('Scan failed: %s' % state['status'])
             self.re_off()
-            self.in_sampling = False
-            raise Exception('Failed to set sweep range')
-#        print ('Command SW returned: ', r)
-        time.sleep(0.02)
-        self.send_re('FRX%d' % nfreq)
-        r = self.get_re()
-        if r not in ['OK']:
-            # print (r)
+            return None
+        n = state['n']  # only the points received (a stopped sweep is partial)
+        if n > 1:
+            td, tdr = self.compute_tdr(freqlist[:n], rtl[:n])
+            self.pl['TDR'].plot(td[1:len(tdr)], tdr[1:], pen=pen)
+        else:
+            tdr = np.zeros(0)
+        if manage_rf:
             self.re_off()
-            self.in_sampling = False
-            raise Exception('Failed to set frx')
-        first = True
-        # dynamically update the plots - 
-        for n in range(len(freqlist)):
-            if self.stopscan:
-                break
-            x = self._readline()
-            if x in ['ERROR']:  # oops, not good
-                self.re_off()
-                self.in_sampling = False
-                raise Exception("Processing canceled by user")
-            if len(x) == 0 or x[0:2] == 'OK':  # an ok means we are done!
-                print ('FRX completed OK')
-                done = True
-            if len(x) != 2:  # line breaks - just skip them
-                results.append(x[:-2])
-                (f,rf,zf) = x.split(b',')
-#                print('n, freq; ', n, f)
-                if float(f) > 0.0:
-                    freqlist[n] = float(f)
-                    rx[n] = float(rf)
-                    zx[n] = float(zf)
-                else:
-                    freqlist[n] = np.nan
-                    rx[n] = np.nan
-                    zx[n] = np.nan
-                swr, rtl = self.compute_swr_and_return_loss(re=rx[0:n], im=zx[0:n], z0=50.)
-                pen = self.plot_results(freq=freqlist[0:n], re=rx[0:n], im=zx[0:n], 
-                                        swr=swr[0:n],
-                                        rtl=rtl[0:n], 
-                                        first=first)
-                first = False
-                n += 1
-        self.in_sampling = False
-        td, tdr = self.compute_tdr(freqlist, rtl)
-        self.pl['TDR'].plot(td[1:len(tdr)], tdr[1:], pen=pen)
-        self.re_off()
         return(freqlist, rx, zx, tdr.real)
 
     def re_off(self):
-        self.send_re('OFF')
-        self.get_re()
+        self._command('OFF')
         #print( 'OFF returned: %s' % (r))
 
-    def send_re(self, cmd):
-        cmd = cmd + '\r'
-
-        self.re_sp.write(cmd.encode())
-        
-    def get_re(self, verbose = False):
-        """
-        Read after a command to the AA-30
-        Commands are a response consisting of:
-        <cr><lf>value<cr><lf>
-        optionally followed by
-        <cr><lf>OK<cr><lf>
+    def _command(self, cmd:str):
+        """Send a simple command to the AA30 (through the acquisition process)
+        and return the response, or None if there was no response.
         """
-        s = ''  # result string
-        string_end_flag = False
-        crlf_count = 0
-        buf = '' # collect the whole buffer
-        while not string_end_flag:
-            buf += self.re_sp.read(1).decode() # do this low-level, character at a time.
-            if len(buf) == 0:  # no characters, likely the device is not on
-                return None
-            if verbose:
-                print ('ts is: %d' %  ord(buf[-1]), buf[-1])
-            if buf[-1] == '\r':  # pop line feeds
-                continue
-            if buf[-1] == '\n' and buf[-2] == '\r':  # catch newlines
-                    crlf_count += 1
-                    if crlf_count == 2:
-                        string_end_flag = True
-                    continue
-            if buf[-3:-1] == 'OK':
-                string_end_flag = True
-            if verbose:
-                print ('buffer: ', buf)
-            s += buf[-1]
-        if verbose: 
-            print ('s:[%s] ' % s)
-        if len(s) > 0:
-            return s
-        else:            
+        if self._worker is None or not self._worker.is_alive():
             return None
+        self._cmd_q.put((cmd,))
+        return self._get_reply()
 
-    def _readline(self):
-        eol = b'\r\n'
-        leneol = len(eol)
-        line = bytearray()
+    def _get_reply(self, timeout:float=10.):
         while True:
-            c = self.re_sp.read(1)
-            if c:
-                line += c
-                if line[-leneol:] == eol:
-                    break
-            else:
-                break
-        return bytes(line)
+            try:
+                msg = self._data_q.get(timeout=timeout)
+            except queue.Empty:
+                return None
+            if msg[0] == 'reply':  # skip anything left over from an abandoned sweep
+                return msg[1]
 
     def storeData(self):
         raise NotImplementedError